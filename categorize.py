@@ -1,4 +1,13 @@
 # categorize.py
+import asyncio
+import atexit
+import functools
+import hashlib
+import json
+import os
+import re
+import shelve
+import time
 import openai
 
 CATEGORIES = [
@@ -16,45 +25,351 @@ CATEGORIES = [
     "Opinion & Editorials"
 ]
 
+MODEL = "gpt-4o-mini"  # swap in a fine-tuned model id here for high-volume runs
+
+# Structured Outputs schema for a numbered list of posts, so every response is parseable.
+# Strict mode needs an object at the root, hence the "labels" wrapper around the array.
+LABELS_SCHEMA = {
+    "name": "Labels",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "labels": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "index": {"type": "integer"},
+                        "category": {"type": "string", "enum": CATEGORIES},
+                        "controversy": {"type": "integer", "minimum": 1, "maximum": 10}
+                    },
+                    "required": ["index", "category", "controversy"],
+                    "additionalProperties": False
+                }
+            }
+        },
+        "required": ["labels"],
+        "additionalProperties": False
+    }
+}
+
+# Built once at import instead of on every request
+PROMPT_PREFIX = f"""
+Given the following numbered news posts, do the following for each one:
+
+1. Categorize it into one of these categories: {', '.join(CATEGORIES)}.
+2. Rate how controversial it is on a scale from 1 to 10 (1 = not controversial, 10 = extremely controversial).
+
+Return one label per post, with the post's number as its index.
+"""
+
+# Returned for posts that could not be categorized; never cached. "Uncategorized" is outside
+# the schema's category enum, so a real label can't collide with it.
+FALLBACK_LABEL = ("Uncategorized", 1)
+
+POSTS_PER_REQUEST = 20  # posts classified by a single chat completion
+TOKENS_PER_LABEL = 30  # max_tokens budget per post in a request
+BATCH_POLL_INTERVAL = 30  # seconds between batch status checks
+BATCH_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+MAX_CONCURRENT_REQUESTS = 16  # in-flight chat completions for the async path
+MIN_TOKENS_REMAINING = 1000  # wait for the token window to reset below this
+CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "categorize_cache.db")
+BATCH_STATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pending_batch.json")
+
 client = None
+aclient = None
 
 def set_openai_api_key(api_key):
-    global client
+    global client, aclient
     client = openai.OpenAI(api_key=api_key)
+    aclient = openai.AsyncOpenAI(api_key=api_key)
 
-def categorize_text(text):
-    if client is None:
-        raise Exception("OpenAI client not initialized. Call set_openai_api_key() first.")
+def _parse_reset(value):
+    # OpenAI reports resets as durations like "1s", "6m0s" or "20ms"
+    seconds = 0.0
+    for amount, unit in re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value or ""):
+        seconds += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return seconds
+
+class RateLimiter:
+    # Token bucket refilled from the x-ratelimit-* headers of each response
+    def __init__(self):
+        self.requests_remaining = None
+        self.requests_reset_at = 0.0
+        self.tokens_remaining = None
+        self.tokens_reset_at = 0.0
+
+    def delay(self):
+        now = time.monotonic()
+        delay = 0.0
+        if self.requests_remaining is not None and self.requests_remaining <= 0:
+            delay = max(delay, self.requests_reset_at - now)
+        if self.tokens_remaining is not None and self.tokens_remaining < MIN_TOKENS_REMAINING:
+            delay = max(delay, self.tokens_reset_at - now)
+        return delay
 
+    async def acquire(self):
+        delay = self.delay()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.delay()
+        if self.requests_remaining is not None:
+            self.requests_remaining -= 1
+
+    def update(self, headers):
+        now = time.monotonic()
+        if "x-ratelimit-remaining-requests" in headers:
+            self.requests_remaining = int(headers["x-ratelimit-remaining-requests"])
+            self.requests_reset_at = now + _parse_reset(headers.get("x-ratelimit-reset-requests"))
+        if "x-ratelimit-remaining-tokens" in headers:
+            self.tokens_remaining = int(headers["x-ratelimit-remaining-tokens"])
+            self.tokens_reset_at = now + _parse_reset(headers.get("x-ratelimit-reset-tokens"))
+
+rate_limiter = RateLimiter()
+
+# === Persistent label cache, keyed by sha256 of the post text ===
+_cache = None
+
+def _get_cache():
+    global _cache
+    if _cache is None:
+        _cache = shelve.open(CACHE_PATH)
+        atexit.register(_cache.close)
+    return _cache
+
+def _cache_key(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+@functools.lru_cache(maxsize=10000)
+def _lookup_label(text):
+    # Raises KeyError on a miss, so only hits are memoized in-process
+    return _get_cache()[_cache_key(text)]
+
+def cached_label(text):
     try:
-        prompt = f"""
-Given the following news post, do the following:
+        return _lookup_label(text)
+    except KeyError:
+        return None
 
-1. Categorize it into one of these categories: {', '.join(CATEGORIES)}.
-2. Rate how controversial it is on a scale from 1 to 10 (1 = not controversial, 10 = extremely controversial).
+def store_label(text, label):
+    _get_cache()[_cache_key(text)] = label
 
-Respond in this JSON format:
-{{"category": "your-category", "controversy": number}}
+def _completion_body(texts):
+    # JSON-encode each post so embedded newlines and quotes can't fake another numbered entry
+    posts = "\n".join(f'{idx}. {json.dumps(text)}' for idx, text in enumerate(texts, start=1))
+    prompt = f"{PROMPT_PREFIX}\nPosts:\n{posts}\n"
+    return {
+        "model": MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": 0.3,
+        "max_tokens": TOKENS_PER_LABEL * len(texts),
+        "response_format": {"type": "json_schema", "json_schema": LABELS_SCHEMA}
+    }
 
-Post:
-\"{text}\"
-"""
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.3,
-            max_tokens=100
-        )
+def _parse_labels(content, refusal, count):
+    # The schema guarantees well-typed labels, but not that every post gets exactly one.
+    # Keep labels whose index is in range and unique; the rest are re-requested by the caller.
+    if refusal:
+        print(f"❌ Model refused to label {count} posts: {refusal}")
+        return {}
+    labels = {}
+    duplicates = set()
+    for item in json.loads(content)["labels"]:
+        pos = item["index"] - 1
+        if not 0 <= pos < count:
+            continue
+        if pos in labels:
+            duplicates.add(pos)
+        labels[pos] = (item["category"], item["controversy"])
+    for pos in duplicates:
+        del labels[pos]
+    return labels
+
+def _chunks(items):
+    for start in range(0, len(items), POSTS_PER_REQUEST):
+        yield items[start:start + POSTS_PER_REQUEST]
+
+def _split_cached(texts):
+    labels = [FALLBACK_LABEL] * len(texts)
+    pending = {}  # uncached text -> indices of every post sharing it
+    for idx, text in enumerate(texts):
+        label = cached_label(text)
+        if label is not None:
+            labels[idx] = label
+        else:
+            pending.setdefault(text, []).append(idx)
+    return labels, pending
 
-        content = response.choices[0].message.content.strip()
+def _apply_labels(labels, pending, chunk, chunk_labels):
+    for pos, label in chunk_labels.items():
+        text = chunk[pos]
+        store_label(text, label)
+        for idx in pending[text]:
+            labels[idx] = label
 
-        # Parse the JSON-like response safely
-        import json
-        result = json.loads(content)
-        category = result.get("category", "Uncategorized")
-        controversy = int(result.get("controversy", 1))
-        return category, controversy
+def build_categorize_request(custom_id, texts):
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": _completion_body(texts)
+    }
 
+async def _categorize_chunk_async(chunk, semaphore):
+    async with semaphore:
+        await rate_limiter.acquire()
+        try:
+            raw = await aclient.chat.completions.with_raw_response.create(**_completion_body(chunk))
+            rate_limiter.update(raw.headers)
+            message = raw.parse().choices[0].message
+            return _parse_labels(message.content, message.refusal, len(chunk))
+
+        except Exception as e:
+            # No usable response at all; splitting the chunk wouldn't help
+            print(f"❌ Categorization failed: {e}")
+            return None
+
+async def _relabel_missing_async(chunk, chunk_labels, semaphore):
+    # Re-request posts a response left unlabelled: just the missing ones, or both halves of
+    # the chunk when nothing came back, so one unclassifiable post only fails on its own
+    missing = [pos for pos in range(len(chunk)) if pos not in chunk_labels]
+    if not missing or len(chunk) == 1:
+        return chunk_labels
+    if len(missing) == len(chunk):
+        groups = [missing[:len(missing) // 2], missing[len(missing) // 2:]]
+    else:
+        groups = [missing]
+    results = await asyncio.gather(*[_label_chunk_async([chunk[pos] for pos in group], semaphore) for group in groups])
+    for group, group_labels in zip(groups, results):
+        for sub_pos, label in group_labels.items():
+            chunk_labels[group[sub_pos]] = label
+    return chunk_labels
+
+async def _label_chunk_async(chunk, semaphore):
+    chunk_labels = await _categorize_chunk_async(chunk, semaphore)
+    if chunk_labels is None:
+        return {}
+    return await _relabel_missing_async(chunk, chunk_labels, semaphore)
+
+# Categorize texts concurrently, POSTS_PER_REQUEST per request; results keep the order of `texts`
+async def categorize_texts_async(texts, semaphore=None):
+    if aclient is None:
+        raise Exception("OpenAI client not initialized. Call set_openai_api_key() first.")
+
+    semaphore = semaphore or asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    labels, pending = _split_cached(texts)
+    chunks = list(_chunks(list(pending)))
+    results = await asyncio.gather(*[_label_chunk_async(chunk, semaphore) for chunk in chunks])
+    for chunk, chunk_labels in zip(chunks, results):
+        _apply_labels(labels, pending, chunk, chunk_labels)
+    return labels
+
+# === In-flight batch state, so an interrupted run resumes its batch instead of paying for a new one ===
+def _save_batch_state(batch_id, chunks):
+    tmp_path = BATCH_STATE_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"batch_id": batch_id, "chunks": chunks}, f)
+    os.replace(tmp_path, BATCH_STATE_PATH)
+
+def _load_batch_state():
+    if not os.path.exists(BATCH_STATE_PATH):
+        return None
+    with open(BATCH_STATE_PATH, "r") as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError:
+            return None
+
+def _clear_batch_state():
+    if os.path.exists(BATCH_STATE_PATH):
+        os.remove(BATCH_STATE_PATH)
+
+# Wait for a batch to finish and return {chunk index: labels}; the state file survives if this is interrupted
+def _collect_batch(batch_id, chunks):
+    batch = client.batches.retrieve(batch_id)
+    while batch.status not in BATCH_TERMINAL_STATUSES:
+        time.sleep(BATCH_POLL_INTERVAL)
+        batch = client.batches.retrieve(batch_id)
+
+    if batch.status != "completed" or not batch.output_file_id:
+        _clear_batch_state()
+        print(f"❌ Batch {batch_id} ended with status '{batch.status}'")
+        return {}
+
+    output = client.files.content(batch.output_file_id).text
+    _clear_batch_state()
+
+    results = {}
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        try:
+            result = json.loads(line)
+            chunk_idx = int(result["custom_id"])
+            response = result.get("response") or {}
+            if response.get("status_code") != 200:
+                print(f"❌ Categorization failed for request {chunk_idx}: {result.get('error')}")
+                continue
+            message = response["body"]["choices"][0]["message"]
+            results[chunk_idx] = _parse_labels(message.get("content"), message.get("refusal"), len(chunks[chunk_idx]))
+        except Exception as e:
+            print(f"❌ Could not parse batch result: {e}")
+    return results
+
+async def _relabel_batch_results_async(chunks, results):
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    await asyncio.gather(*[
+        _relabel_missing_async(chunks[chunk_idx], chunk_labels, semaphore)
+        for chunk_idx, chunk_labels in results.items()
+    ])
+
+def _finish_batch(chunks, results, labels, pending):
+    # Posts the batch answered for but left unlabelled are re-requested directly, in smaller requests
+    if aclient is not None and any(len(results[idx]) < len(chunks[idx]) for idx in results):
+        asyncio.run(_relabel_batch_results_async(chunks, results))
+    for chunk_idx, chunk_labels in results.items():
+        _apply_labels(labels, pending, chunks[chunk_idx], chunk_labels)
+
+# Categorize many texts with one Batch API job; results keep the order of `texts`
+def categorize_batch(texts):
+    if client is None:
+        raise Exception("OpenAI client not initialized. Call set_openai_api_key() first.")
+
+    state = _load_batch_state()
+    if state:
+        # Results land in the label cache, so this run's texts from that batch become cache hits
+        print(f"⏳ Resuming batch {state['batch_id']} from an earlier run...")
+        resumed_pending = {text: [] for chunk in state["chunks"] for text in chunk}
+        try:
+            results = _collect_batch(state["batch_id"], state["chunks"])
+            _finish_batch(state["chunks"], results, [], resumed_pending)
+        except Exception as e:
+            print(f"❌ Could not resume batch {state['batch_id']}: {e}")
+            return _split_cached(texts)[0]
+
+    labels, pending = _split_cached(texts)
+    if not pending:
+        return labels
+
+    chunks = list(_chunks(list(pending)))
+    try:
+        payload = "\n".join(
+            json.dumps(build_categorize_request(str(chunk_idx), chunk))
+            for chunk_idx, chunk in enumerate(chunks)
+        )
+        input_file = client.files.create(
+            file=("categorize_batch.jsonl", payload.encode("utf-8")),
+            purpose="batch"
+        )
+        batch = client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        _save_batch_state(batch.id, chunks)
+        _finish_batch(chunks, _collect_batch(batch.id, chunks), labels, pending)
     except Exception as e:
-        print(f"❌ Categorization failed: {e}")
-        return "Uncategorized", 1
+        print(f"❌ Batch categorization failed: {e}")
+
+    return labels
@@ -1,20 +1,28 @@
 #!/usr/bin/env python3
+import asyncio
+import fcntl
+import functools
 import logging
-import re
 import time
 import json
 import os
-from atproto import Client
-from datetime import datetime
+import sqlite3
+import aiohttp
+from atproto import Client, SessionEvent
+from datetime import datetime, timezone
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
-from categorize import categorize_text, set_openai_api_key
+from categorize import FALLBACK_LABEL, MAX_CONCURRENT_REQUESTS, categorize_batch, categorize_texts_async, set_openai_api_key
 
 # === Absolute base path (for cron safety) ===
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 # === Editable Throttling Config ===
-DELAY_BETWEEN_API_CALLS = 3  # seconds between API calls
+PROFILES_BATCH_SIZE = 25  # app.bsky.actor.getProfiles accepts at most 25 actors
+MAX_CONNECTIONS_PER_HOST = 8  # concurrent feed requests to the Bluesky AppView
+MAX_CATEGORIZE_ATTEMPTS = 3  # runs a post may fail categorization before it's sent as Uncategorized
+RATE_LIMIT_THRESHOLD = 5  # pause until the window resets once fewer requests remain
+BSKY_APPVIEW_URL = "https://public.api.bsky.app"
 
 # === Load config ===
 CONFIG_PATH = os.path.join(BASE_DIR, "config.json")
@@ -27,10 +35,16 @@ SPREADSHEET_ID = CONFIG['spreadsheet_id']
 SHEET_NAME = CONFIG['sheet_name']
 USER_LIST_FILE = os.path.join(BASE_DIR, CONFIG['user_list_file'])
 POST_LIMIT = CONFIG['post_limit']
-DELAY_BETWEEN_USERS = CONFIG['delay_between_users']
 OPENAI_API_KEY = CONFIG['openai_api_key']
-SCRAPED_DATA_FILE = os.path.join(BASE_DIR, 'scraped_posts.json')
+USE_BATCH_API = CONFIG.get('use_batch_api', False)  # True = one cheaper Batch API job, results within 24h
+POSTS_DB_PATH = os.path.join(BASE_DIR, 'posts.db')
+SCRAPED_DATA_FILE = os.path.join(BASE_DIR, 'scraped_posts.json')  # legacy URI store, imported once
 CREDENTIALS_PATH = os.path.join(BASE_DIR, 'credentials.json')
+LOCK_PATH = os.path.join(BASE_DIR, 'pull.lock')
+SESSION_PATH = os.path.join(BASE_DIR, 'session.txt')
+SESSION_MAX_AGE = 24 * 60 * 60  # seconds a saved session is reused before logging in again
+# Fallback for posts without createdAt, in the same format Bluesky uses (e.g. 2024-01-01T12:00:00.000Z)
+RUN_STARTED_AT = datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
 
 # === Set OpenAI API Key ===
 set_openai_api_key(OPENAI_API_KEY)
@@ -48,31 +62,66 @@ logging.basicConfig(
 def safe_request(api_call_fn, *args, max_retries=5, initial_delay=5, **kwargs):
     delay = initial_delay
     for attempt in range(max_retries):
+        # Only pause when the last response said the rate limit window is nearly spent
+        time.sleep(pds_rate_limit.delay())
         try:
-            result = api_call_fn(*args, **kwargs)
-            time.sleep(DELAY_BETWEEN_API_CALLS)
-            return result
+            return api_call_fn(*args, **kwargs)
         except Exception as e:
             if "429" in str(e) or "Too Many Requests" in str(e):
-                logging.warning(f"⚠️ Rate limit hit, sleeping {delay}s (attempt {attempt + 1})...")
-                time.sleep(delay)
+                wait = pds_rate_limit.delay() or delay
+                logging.warning(f"⚠️ Rate limit hit, sleeping {wait:.0f}s (attempt {attempt + 1})...")
+                time.sleep(wait)
                 delay = min(delay * 2, 120)
             else:
                 logging.error(f"❌ API call failed: {e}")
                 break
     return None
 
+class BlueskyRateLimit:
+    # Tracks the ratelimit-* headers Bluesky sends back with every response
+    def __init__(self):
+        self.remaining = None
+        self.reset_at = 0.0
+
+    def update(self, headers):
+        remaining = headers.get('ratelimit-remaining') or headers.get('x-ratelimit-remaining')
+        reset = headers.get('ratelimit-reset') or headers.get('x-ratelimit-reset')
+        if remaining is None or reset is None:
+            return
+        self.remaining = int(remaining)
+        self.reset_at = float(reset)  # unix timestamp
+
+    def delay(self):
+        if self.remaining is None or self.remaining >= RATE_LIMIT_THRESHOLD:
+            return 0
+        return max(0.0, self.reset_at - time.time())
+
+# Each host keeps its own rate limit window, so track them separately
+pds_rate_limit = BlueskyRateLimit()  # the atproto client's PDS (login, getProfiles)
+appview_rate_limit = BlueskyRateLimit()  # BSKY_APPVIEW_URL (author feeds)
+
+def watch_rate_limit(client: Client):
+    # atproto doesn't expose response headers, so hook the httpx client underneath it
+    http_client = getattr(getattr(client, 'request', None), '_client', None)
+    if http_client is None:
+        logging.warning("⚠️ Could not attach rate limit hook to the atproto client.")
+        return
+    http_client.event_hooks['response'].append(lambda response: pds_rate_limit.update(response.headers))
+
 def clean_text(text: str) -> str:
-    text = re.sub(r'[\U00010000-\U0010FFFF]+', '', text)
-    text = re.sub(r'[^\x00-\x7F]+', '', text)
-    return text.strip()
+    # Drop every non-ASCII character (emoji included) in a single pass
+    return text.encode('ascii', 'ignore').decode('ascii').strip()
+
+@functools.lru_cache(maxsize=1)
+def get_sheets_service():
+    creds = Credentials.from_service_account_file(CREDENTIALS_PATH, scopes=["https://www.googleapis.com/auth/spreadsheets"])
+    # Use the discovery document bundled with the client instead of fetching it
+    service = build('sheets', 'v4', credentials=creds, cache_discovery=False, static_discovery=True)
+    return service.spreadsheets()
 
 def send_to_google_sheets(rows):
     try:
-        creds = Credentials.from_service_account_file(CREDENTIALS_PATH, scopes=["https://www.googleapis.com/auth/spreadsheets"])
-        service = build('sheets', 'v4', credentials=creds)
-        sheet = service.spreadsheets()
-
+        sheet = get_sheets_service()
         body = {
             'values': rows  # Only data rows, no headers
         }
@@ -86,64 +135,242 @@ def send_to_google_sheets(rows):
         ).execute()
 
         logging.info(f"✅ Appended {len(rows)} new posts to Google Sheets.")
+        return True
     except Exception as e:
         logging.error(f"❌ Failed to write to Google Sheets: {e}")
+        return False
+
+def open_post_store():
+    conn = sqlite3.connect(POSTS_DB_PATH)
+    # Write-ahead log: each commit appends to posts.db-wal instead of rewriting pages in place
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS posts("
+        "uri TEXT PRIMARY KEY, handle TEXT, ts TEXT, category TEXT, controversy INT, text TEXT, "
+        "attempts INT NOT NULL DEFAULT 0)"
+    )
+    # Databases created before failed categorizations were tracked lack the attempts column
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(posts)")}
+    if 'attempts' not in columns:
+        conn.execute("ALTER TABLE posts ADD COLUMN attempts INT NOT NULL DEFAULT 0")
+    import_legacy_post_uris(conn)
+    return conn
 
-def load_existing_post_uris():
+def import_legacy_post_uris(conn):
     if not os.path.exists(SCRAPED_DATA_FILE):
-        return set()
+        return
     with open(SCRAPED_DATA_FILE, 'r') as f:
         try:
-            data = json.load(f)
-            return set(data.get("uris", []))
+            uris = json.load(f).get("uris", [])
         except json.JSONDecodeError:
-            return set()
+            uris = []
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO posts(uri) VALUES(?)", ((uri,) for uri in uris))
+    os.replace(SCRAPED_DATA_FILE, SCRAPED_DATA_FILE + '.migrated')
+    logging.info(f"📦 Imported {len(uris)} URIs from {SCRAPED_DATA_FILE} into {POSTS_DB_PATH}.")
 
-def save_post_uris(uris):
-    with open(SCRAPED_DATA_FILE, 'w') as f:
-        json.dump({"uris": list(uris)}, f, indent=2)
+def known_post_uris(conn, uris):
+    # One query per feed; only the already-stored URIs from this feed are held in memory
+    if not uris:
+        return set()
+    placeholders = ",".join("?" * len(uris))
+    return {row[0] for row in conn.execute(f"SELECT uri FROM posts WHERE uri IN ({placeholders})", uris)}
 
-def get_posts_for_user(client: Client, handle: str):
-    profile = safe_request(client.com.atproto.identity.resolve_handle, {'handle': handle})
-    if not profile or not hasattr(profile, 'did'):
-        logging.error(f"❌ Could not resolve DID for {handle}")
-        return []
+def save_posts(conn, rows):
+    # Rows are [timestamp, text, uri, handle, category, controversy]; a retried post gets its label filled in
+    with conn:
+        conn.executemany(
+            "INSERT INTO posts(uri, handle, ts, category, controversy, text) VALUES(?,?,?,?,?,?) "
+            "ON CONFLICT(uri) DO UPDATE SET category = excluded.category, controversy = excluded.controversy",
+            [(uri, handle, ts, category, controversy, text) for ts, text, uri, handle, category, controversy in rows]
+        )
+
+def load_retry_posts(conn):
+    # Posts that failed categorization on an earlier run (NULL category), with their attempt counts.
+    # They're retried from here rather than the feed, so they aren't lost once they scroll out of it.
+    return [
+        ((ts, text, uri, handle), attempts)
+        for uri, handle, ts, text, attempts in conn.execute(
+            "SELECT uri, handle, ts, text, attempts FROM posts WHERE category IS NULL AND attempts > 0"
+        )
+    ]
+
+def save_failed_attempts(conn, failed):
+    # `failed` holds ((timestamp, text, uri, handle), attempts) for posts to retry next run
+    with conn:
+        conn.executemany(
+            "INSERT INTO posts(uri, handle, ts, text, attempts) VALUES(?,?,?,?,?) "
+            "ON CONFLICT(uri) DO UPDATE SET attempts = excluded.attempts",
+            [(uri, handle, ts, text, attempts) for (ts, text, uri, handle), attempts in failed]
+        )
+
+def resolve_dids_individually(client: Client, handles):
+    dids = {}
+    for handle in handles:
+        if handle.startswith('did:'):
+            dids[handle] = handle
+            continue
+        profile = safe_request(client.com.atproto.identity.resolve_handle, {'handle': handle})
+        if profile and hasattr(profile, 'did'):
+            dids[handle.lower()] = profile.did
+    return dids
+
+def resolve_dids(client: Client, handles):
+    dids = {}
+    for start in range(0, len(handles), PROFILES_BATCH_SIZE):
+        chunk = handles[start:start + PROFILES_BATCH_SIZE]
+        response = safe_request(client.app.bsky.actor.get_profiles, {'actors': chunk})
+        if not response or not hasattr(response, 'profiles'):
+            # One bad entry can fail the whole call; resolve the chunk one handle at a time instead
+            logging.warning(f"⚠️ getProfiles failed for {len(chunk)} users, resolving them individually...")
+            dids.update(resolve_dids_individually(client, chunk))
+            continue
+        for profile in response.profiles:
+            # Key by DID too, so a user list may mix handles and DIDs
+            dids[profile.handle.lower()] = profile.did
+            dids[profile.did] = profile.did
+    return dids
 
-    did = profile.did
+async def fetch_author_feed(session, handle, did, max_retries=5, initial_delay=5):
+    url = f"{BSKY_APPVIEW_URL}/xrpc/app.bsky.feed.getAuthorFeed"
+    delay = initial_delay
     logging.info(f"🔍 Fetching posts for {handle} ({did})...")
-    feed = safe_request(client.app.bsky.feed.get_author_feed, {'actor': did, 'limit': POST_LIMIT})
-    if not feed or not hasattr(feed, 'feed'):
-        logging.error(f"❌ Failed to fetch feed for {handle}")
-        return []
+    for attempt in range(max_retries):
+        await asyncio.sleep(appview_rate_limit.delay())
+        try:
+            async with session.get(url, params={'actor': did, 'limit': POST_LIMIT}) as response:
+                appview_rate_limit.update(response.headers)
+                if response.status == 429 or response.status >= 500:
+                    wait = (response.status == 429 and appview_rate_limit.delay()) or delay
+                    logging.warning(f"⚠️ HTTP {response.status} fetching {handle}, sleeping {wait:.0f}s (attempt {attempt + 1})...")
+                    await asyncio.sleep(wait)
+                    delay = min(delay * 2, 120)
+                    continue
+                response.raise_for_status()
+                return await response.json()
+        except aiohttp.ClientResponseError as e:
+            logging.error(f"❌ Failed to fetch feed for {handle}: {e}")
+            return None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning(f"⚠️ Network error fetching {handle}: {e!r}, sleeping {delay}s (attempt {attempt + 1})...")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 120)
+        except Exception as e:
+            logging.error(f"❌ Failed to fetch feed for {handle}: {e}")
+            return None
+    logging.error(f"❌ Giving up on feed for {handle} after {max_retries} attempts")
+    return None
+
+def open_feed_session():
+    connector = aiohttp.TCPConnector(limit_per_host=MAX_CONNECTIONS_PER_HOST)
+    return aiohttp.ClientSession(connector=connector)
 
-    rows = []
-    for idx, post in enumerate(feed.feed, start=1):
+def iter_posts_for_user(handle: str, feed, conn):
+    items = feed.get('feed', [])
+    uris = [item['post']['uri'] for item in items if 'uri' in item.get('post', {})]
+    seen_uris = known_post_uris(conn, uris)
+    for idx, item in enumerate(items, start=1):
         try:
-            record = post.post.record
+            post = item['post']
+            record = post.get('record', {})
 
             # ✅ Filter out reposts (quotes)
-            if post.reason is not None:
+            if item.get('reason') is not None:
                 continue
 
             # ✅ Filter out replies
-            if hasattr(record, 'reply') and record.reply is not None:
+            if record.get('reply') is not None:
                 continue
 
             # ✅ Filter out textless or embed-only posts
-            if not hasattr(record, 'text') or not record.text.strip():
+            if not record.get('text', '').strip():
                 continue
-            if hasattr(record, 'embed') and not record.text.strip():
+
+            # ✅ Skip posts already scraped on an earlier run, before any further work on them
+            uri = post['uri']
+            if uri in seen_uris:
                 continue
 
-            text = clean_text(record.text)
-            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            uri = post.post.uri
-            category, controversy = categorize_text(text)
-            rows.append([timestamp, text, uri, handle, category, controversy])
+            text = clean_text(record['text'])
+            timestamp = record.get('createdAt') or RUN_STARTED_AT
+            yield timestamp, text, uri, handle
         except Exception as e:
             logging.warning(f"⚠️ Error processing post #{idx} from {handle}: {e}")
 
-    return rows
+async def fetch_new_posts(session, handle, did, conn):
+    feed = await fetch_author_feed(session, handle, did)
+    if feed is None:
+        return []
+
+    posts = list(iter_posts_for_user(handle, feed, conn))
+    if posts:
+        logging.info(f"🆕 Found {len(posts)} new posts from {handle}.")
+    else:
+        logging.info(f"📭 No new posts found for {handle}.")
+    return posts
+
+async def fetch_all_new_posts(targets, conn):
+    async with open_feed_session() as session:
+        results = await asyncio.gather(*[fetch_new_posts(session, handle, did, conn) for handle, did in targets])
+    return [post for posts in results for post in posts]
+
+async def scrape_realtime(targets, conn, retry_posts):
+    # Each user's posts start categorizing as soon as their feed arrives, while other feeds are still loading
+    # gather() still runs users concurrently but returns them in user-list order, as batch mode does
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    async with open_feed_session() as session:
+        async def label_posts(posts):
+            labels = await categorize_texts_async([post[1] for post in posts], semaphore)
+            return [[*post, category, controversy] for post, (category, controversy) in zip(posts, labels)]
+
+        async def process_user(handle, did):
+            return await label_posts(await fetch_new_posts(session, handle, did, conn))
+
+        results = await asyncio.gather(
+            label_posts(retry_posts),
+            *[process_user(handle, did) for handle, did in targets]
+        )
+    return [row for user_rows in results for row in user_rows]
+
+def load_session_string():
+    if not os.path.exists(SESSION_PATH):
+        return None
+    if time.time() - os.path.getmtime(SESSION_PATH) > SESSION_MAX_AGE:
+        return None
+    with open(SESSION_PATH, 'r') as f:
+        return f.read().strip() or None
+
+def save_session_string(session_string):
+    fd = os.open(SESSION_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(session_string)
+    os.chmod(SESSION_PATH, 0o600)
+
+def on_session_change(event, session):
+    # Persist new and refreshed tokens so the next run can skip the password login
+    if event in (SessionEvent.CREATE, SessionEvent.REFRESH):
+        save_session_string(session.export())
+
+def login(client: Client):
+    session_string = load_session_string()
+    if session_string:
+        logging.info("🔐 Resuming saved session...")
+        if safe_request(client.login, session_string=session_string) is not None:
+            return True
+        logging.warning("⚠️ Saved session was rejected, logging in with password...")
+
+    logging.info("🔐 Logging in...")
+    return safe_request(client.login, USERNAME, PASSWORD) is not None
+
+def acquire_run_lock():
+    # A batch-mode run can outlast the cron interval; overlapping runs would resend the same posts
+    lock_file = open(LOCK_PATH, 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
 
 def get_user_list(filepath):
     try:
@@ -154,12 +381,16 @@ def get_user_list(filepath):
         return []
 
 def main():
+    run_lock = acquire_run_lock()
+    if run_lock is None:
+        logging.warning("⚠️ Another run is still in progress, skipping this one.")
+        return
+
     client = Client()
-    try:
-        logging.info("🔐 Logging in...")
-        safe_request(client.login, USERNAME, PASSWORD)
-    except Exception as e:
-        logging.error(f"❌ Login failed: {e}")
+    watch_rate_limit(client)
+    client.on_session_change(on_session_change)
+    if not login(client):
+        logging.error("❌ Login failed")
         return
 
     users = get_user_list(USER_LIST_FILE)
@@ -167,27 +398,76 @@ def main():
         logging.warning("⚠️ No users to scrape.")
         return
 
-    existing_uris = load_existing_post_uris()
-    updated_uris = set(existing_uris)
+    try:
+        get_sheets_service()
+    except Exception as e:
+        logging.error(f"❌ Could not connect to Google Sheets: {e}")
+        return
 
+    dids = resolve_dids(client, users)
+
+    conn = open_post_store()
+
+    # Each account is scraped once per run, even if it's listed twice or as both handle and DID
+    targets = []
+    seen_dids = set()
     for user in users:
-        new_rows = []
-        rows = get_posts_for_user(client, user)
-        for row in rows:
-            uri = row[2]
-            if uri not in updated_uris:
-                new_rows.append(row)
-                updated_uris.add(uri)
-
-        if new_rows:
-            logging.info(f"📤 Sending {len(new_rows)} new posts from {user} to Google Sheets...")
-            send_to_google_sheets(new_rows)
-            save_post_uris(updated_uris)
-        else:
-            logging.info(f"📭 No new posts found for {user}.")
-
-        logging.info(f"⏱ Waiting {DELAY_BETWEEN_USERS}s before next user...")
-        time.sleep(DELAY_BETWEEN_USERS)
+        did = dids.get(user) or dids.get(user.lower())
+        if not did:
+            logging.error(f"❌ Could not resolve DID for {user}")
+            continue
+        if did in seen_dids:
+            logging.info(f"↪️ Skipping {user} ({did}), already in the user list.")
+            continue
+        seen_dids.add(did)
+        targets.append((user, did))
+
+    previous_attempts = {}
+    retry_posts = []
+    for post, attempts in load_retry_posts(conn):
+        previous_attempts[post[2]] = attempts
+        retry_posts.append(post)
+    if retry_posts:
+        logging.info(f"🔁 Retrying categorization for {len(retry_posts)} posts from earlier runs...")
+
+    if USE_BATCH_API:
+        # Collect unseen posts from every user first so they can be categorized in one batch job
+        posts = retry_posts + asyncio.run(fetch_all_new_posts(targets, conn))
+        all_new_rows = []
+        if posts:
+            logging.info(f"🧠 Submitting {len(posts)} posts for batch categorization...")
+            labels = categorize_batch([post[1] for post in posts])
+            all_new_rows = [[*post, category, controversy] for post, (category, controversy) in zip(posts, labels)]
+    else:
+        all_new_rows = asyncio.run(scrape_realtime(targets, conn, retry_posts))
+
+    # Hold uncategorized posts back for another run until they've failed MAX_CATEGORIZE_ATTEMPTS times,
+    # then send them as Uncategorized so they still reach Sheets
+    to_retry = []
+    rows_to_send = []
+    for row in all_new_rows:
+        if tuple(row[4:6]) == FALLBACK_LABEL:
+            attempts = previous_attempts.get(row[2], 0) + 1
+            if attempts < MAX_CATEGORIZE_ATTEMPTS:
+                to_retry.append((tuple(row[:4]), attempts))
+                continue
+            logging.warning(f"⚠️ Giving up on categorizing {row[2]} after {attempts} attempts.")
+        rows_to_send.append(row)
+    if to_retry:
+        logging.warning(f"⚠️ {len(to_retry)} posts could not be categorized; they will be retried next run.")
+        save_failed_attempts(conn, to_retry)
+    all_new_rows = rows_to_send
+
+    if not all_new_rows:
+        conn.close()
+        logging.info("✅ Finished scraping all users.")
+        return
+
+    # One append for the whole run instead of one write request per user
+    logging.info(f"📤 Sending {len(all_new_rows)} new posts to Google Sheets...")
+    if send_to_google_sheets(all_new_rows):
+        save_posts(conn, all_new_rows)
+    conn.close()
 
     logging.info("✅ Finished scraping all users.")
 